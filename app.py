@@ -244,32 +244,134 @@
 #     app.run(host="0.0.0.0", port=8000)
 
 
-import json
+import logging
+import orjson
+import queue
+import re
+import string
 import struct
 import pyodbc
 import os
-import traceback
+import threading
+import time
 
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from azure.identity import ClientSecretCredential
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# ---------------- LOGGING ----------------
+# Handlers run on a background thread so request threads never block
+# on stdout flushes.
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
+
+
+class ORJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# ---------------- OPENAI CLIENT ----------------
+# One client for the process so httpx keeps the TLS connection to
+# Azure OpenAI alive across requests. The sync client is deliberate:
+# Flask runs async views in a per-request event loop, which would leave
+# a shared async client's pooled connections bound to closed loops.
+openai_client = AzureOpenAI(
+    api_key=os.getenv("AZURE_OPENAI_KEY"),
+    api_version="2024-12-01-preview",
+    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+)
+
+# Identical (system, user) prompt pairs always produce the same
+# temperature-0 output, so never ask OpenAI twice for them.
+CHAT_CACHE_MAX = 2048
+
+_chat_cache = {}
+_chat_cache_lock = threading.Lock()
+
+
+def _chat(system_prompt, user_prompt, model="gpt-4o-mini",
+          temperature=0, max_tokens=None, stop=None):
+    key = (system_prompt, user_prompt, model, temperature, max_tokens,
+           tuple(stop) if stop else None)
+
+    with _chat_cache_lock:
+        if key in _chat_cache:
+            return _chat_cache[key]
+
+    response = openai_client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stop=stop
+    )
+
+    content = response.choices[0].message.content
+
+    with _chat_cache_lock:
+        if len(_chat_cache) >= CHAT_CACHE_MAX:
+            _chat_cache.clear()
+        _chat_cache[key] = content
+
+    return content
 
 # ---------------- DB CONNECTION ----------------
-def get_db_connection():
-    credential = ClientSecretCredential(
-        tenant_id=os.getenv("AZURE_TENANT_ID"),
-        client_id=os.getenv("AZURE_CLIENT_ID"),
-        client_secret=os.getenv("AZURE_CLIENT_SECRET")
-    )
+# The pool below manages connections in Python; keep the ODBC-level
+# pool off so the two don't fight over connection lifetimes.
+pyodbc.pooling = False
 
-    token = credential.get_token(
-        "https://database.windows.net/.default"
-    ).token
+MAX_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+_pool = queue.Queue(maxsize=MAX_POOL_SIZE)
+
+# One credential for the process; azure-identity caches tokens inside
+# the credential object, so recreating it per call would defeat that.
+_credential = ClientSecretCredential(
+    tenant_id=os.getenv("AZURE_TENANT_ID"),
+    client_id=os.getenv("AZURE_CLIENT_ID"),
+    client_secret=os.getenv("AZURE_CLIENT_SECRET")
+)
+
+_token_cache = None
+_token_lock = threading.Lock()
+
+
+def _get_access_token():
+    global _token_cache
+
+    with _token_lock:
+        if _token_cache and _token_cache[1] - time.time() > 60:
+            return _token_cache[0]
+
+        token = _credential.get_token(
+            "https://database.windows.net/.default"
+        )
+
+        _token_cache = (token.token, token.expires_on)
+        return token.token
+
+
+def get_db_connection():
+    token = _get_access_token()
 
     SQL_COPT_SS_ACCESS_TOKEN = 1256
     token_bytes = token.encode("UTF-16-LE")
@@ -288,49 +390,187 @@ def get_db_connection():
         "Connection Timeout=30;"
     )
 
+    # Read-only workload: autocommit avoids implicit-transaction
+    # overhead on Azure SQL.
     return pyodbc.connect(
         conn_str,
+        autocommit=True,
         attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct}
     )
 
+
+def _connection_alive(conn):
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        finally:
+            cursor.close()
+        return True
+    except pyodbc.Error:
+        return False
+
+
+@contextmanager
+def get_conn():
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = get_db_connection()
+    else:
+        if not _connection_alive(conn):
+            try:
+                conn.close()
+            except pyodbc.Error:
+                pass
+            conn = get_db_connection()
+
+    try:
+        yield conn
+    except Exception:
+        # Assume the connection is poisoned and drop it.
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+        raise
+    else:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def fetch_schema(company_name):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            return get_schema_info(cursor, company_name)
+        finally:
+            cursor.close()
+
+
+def run_sql(sql):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            return execute_sql(sql, cursor)
+        finally:
+            cursor.close()
+
+# ---------------- SCHEMA CACHE ----------------
+SCHEMA_CACHE_TTL = int(os.getenv("CACHE_SCHEMA_TTL", "900"))
+
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
 # ---------------- SCHEMA ----------------
 def get_schema_info(cursor, company_name):
-    schema_info = {}
+    now = time.monotonic()
+
+    with _schema_cache_lock:
+        cached = _schema_cache.get(company_name)
+        if cached and now - cached[0] < SCHEMA_CACHE_TTL:
+            return cached[1]
 
     cursor.execute("""
-        SELECT TABLE_SCHEMA, TABLE_NAME
-        FROM INFORMATION_SCHEMA.VIEWS
-        WHERE TABLE_SCHEMA = ?
-          AND TABLE_NAME LIKE 'vw_%'
+        SELECT c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE
+        FROM INFORMATION_SCHEMA.COLUMNS c
+        JOIN INFORMATION_SCHEMA.VIEWS v
+          ON c.TABLE_SCHEMA = v.TABLE_SCHEMA
+         AND c.TABLE_NAME = v.TABLE_NAME
+        WHERE c.TABLE_SCHEMA = ?
+          AND c.TABLE_NAME LIKE 'vw_%'
+        ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
     """, (company_name,))
 
-    views = cursor.fetchall()
+    columns_by_view = {}
+    for schema, view, col, dtype in cursor.fetchall():
+        columns_by_view.setdefault(f"{schema}.{view}", []).append(
+            f"{col}:{dtype}"
+        )
 
-    for schema, view in views:
-        cursor.execute("""
-            SELECT COLUMN_NAME, DATA_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA = ?
-              AND TABLE_NAME = ?
-            ORDER BY ORDINAL_POSITION
-        """, (schema, view))
+    # Each view maps to a compact "col:type,col:type,..." string — far
+    # fewer tokens than JSON when embedded in the prompt.
+    schema_info = {
+        name: ",".join(cols) for name, cols in columns_by_view.items()
+    }
 
-        schema_info[f"{schema}.{view}"] = [
-            {"name": col, "type": dtype}
-            for col, dtype in cursor.fetchall()
-        ]
+    with _schema_cache_lock:
+        _schema_cache[company_name] = (time.monotonic(), schema_info)
 
     return schema_info
 
-# ---------------- SQL GENERATION ----------------
-def generate_sql(question, schema_info, company_name):
-    client = AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version="2024-12-01-preview",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
 
-    system_prompt =f"""
+# The views every prompt should keep even without a keyword match.
+STANDARD_VIEWS = ("vw_Activities", "vw_Users", "vw_Bills", "vw_Matters")
+
+
+def filter_schema_for_question(question, schema_info):
+    q = question.lower()
+
+    filtered = {}
+    for name, columns in schema_info.items():
+        view = name.split(".", 1)[-1]
+
+        if view in STANDARD_VIEWS:
+            filtered[name] = columns
+            continue
+
+        keywords = [view.lower().removeprefix("vw_")]
+        keywords += [col.split(":", 1)[0].lower() for col in columns.split(",")]
+
+        if any(k in q or k.replace("_", " ") in q for k in keywords):
+            filtered[name] = columns
+
+    return filtered
+
+# ---------------- SQL CACHE ----------------
+SQL_CACHE_TTL = int(os.getenv("CACHE_SQL_TTL", "900"))
+
+_sql_cache = {}
+_sql_cache_lock = threading.Lock()
+
+
+def _normalize_question(question):
+    return " ".join(re.sub(r"[^a-z0-9\s]", " ", question.lower()).split())
+
+
+def _schema_version(schema_info):
+    return hash(tuple(sorted(schema_info.items())))
+
+
+_FENCE_RE = re.compile(r"```sql|```|`")
+
+# ---------------- QUESTION PRECHECK ----------------
+DOMAIN_KEYWORDS = {
+    "activity", "activities", "amount", "attorney", "attorneys",
+    "bill", "billable", "billed", "bills", "client", "clients",
+    "fee", "fees", "firm", "hour", "hours", "matter", "matters",
+    "revenue", "time", "user", "users",
+}
+
+
+def question_is_answerable(question, schema_info):
+    q = _normalize_question(question)
+
+    keywords = set(DOMAIN_KEYWORDS)
+    for name, columns in schema_info.items():
+        keywords.add(name.split(".", 1)[-1].lower().removeprefix("vw_"))
+        for col in columns.split(","):
+            col_name = col.split(":", 1)[0].lower()
+            keywords.add(col_name.replace("_", " "))
+            # Skip short fragments like 'in'/'id'/'is' that would let
+            # any question through the gate.
+            keywords.update(w for w in col_name.split("_") if len(w) >= 3)
+
+    # Substring match so inflections ('billers', 'revenues') still hit;
+    # a miss here fails closed on the user, so err toward the LLM.
+    return any(k in q for k in keywords)
+
+# ---------------- SQL GENERATION ----------------
+_SQL_SYSTEM_PROMPT_TEMPLATE = string.Template("""
 You are an expert SQL query generator for a Microsoft Fabric Warehouse
 used with a Clio-based law firm management system.
 
@@ -341,7 +581,7 @@ data types, and relationships.
 ────────────────────────────────
 CORE PLATFORM RULES (NON-NEGOTIABLE)
 ────────────────────────────────
-• Use ONLY the '{company_name}' schema.
+• Use ONLY the '${company_name}' schema.
 • ALL queryable objects are VIEWS only (vw_*).
 • NEVER use dbo, sys, or base tables.
 • NEVER invent views or columns.
@@ -449,10 +689,10 @@ AGGREGATION RULES
 ────────────────────────────────
 STANDARD VIEW ALIASES
 ────────────────────────────────
-• Activities → {company_name}.vw_Activities a
-• Users      → {company_name}.vw_Users u
-• Bills      → {company_name}.vw_Bills b
-• Matters    → {company_name}.vw_Matters m
+• Activities → ${company_name}.vw_Activities a
+• Users      → ${company_name}.vw_Users u
+• Bills      → ${company_name}.vw_Bills b
+• Matters    → ${company_name}.vw_Matters m
 
 ────────────────────────────────
 FINAL INSTRUCTION
@@ -461,40 +701,98 @@ Generate a SQL query that correctly answers the user's question.
 Return ONLY the SQL query.
 If schema_info does not support the question,
 return an EMPTY string.
-"""
+""")
+
+# The template only varies by company, so keep the substituted prompts
+# around instead of rebuilding the ~4 KB string per request.
+_sql_system_prompts = {}
+
 
+def generate_sql(question, schema_info, company_name):
+    cache_key = (
+        company_name,
+        _normalize_question(question),
+        _schema_version(schema_info)
+    )
+
+    with _sql_cache_lock:
+        cached = _sql_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < SQL_CACHE_TTL:
+            return cached[1]
+
+    system_prompt = _sql_system_prompts.get(company_name)
+    if system_prompt is None:
+        system_prompt = _SQL_SYSTEM_PROMPT_TEMPLATE.substitute(
+            company_name=company_name
+        )
+        _sql_system_prompts[company_name] = system_prompt
+
+    prompt_schema = filter_schema_for_question(question, schema_info)
+
+    schema_block = "\n".join(
+        f"{name}({columns})" for name, columns in prompt_schema.items()
+    )
 
     user_prompt = f"""
 Schema Info:
-{json.dumps(schema_info)}
+{schema_block}
 
 User Question:
 {question}
 """
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        temperature=0
-    )
+    # A single query fits well inside 400 tokens; stopping at the first
+    # ';' cuts off any trailing commentary the prompt failed to suppress.
+    content = _chat(system_prompt, user_prompt, max_tokens=400, stop=[";"])
 
-    return (
-        response.choices[0].message.content
-        .replace("```sql", "")
-        .replace("```", "")
-        .replace("`", "")
-        .strip()
-    )
+    sql = _FENCE_RE.sub("", content).strip()
+
+    with _sql_cache_lock:
+        _sql_cache[cache_key] = (time.monotonic(), sql)
+
+    return sql
 
 # ---------------- EXECUTE SQL ----------------
+MAX_RESULT_ROWS = int(os.getenv("MAX_RESULT_ROWS", "5000"))
+
+# Numeric literals directly after a comparison operator. Deliberately
+# narrow so TOP n, DATEFROMPARTS arguments etc. are left alone.
+_NUM_LITERAL_RE = re.compile(r"(=|<>|!=|<=|>=|<|>)\s*(\d+(?:\.\d+)?)(?![\w.])")
+
+
+def parameterize_sql(sql):
+    params = []
+
+    def repl(match):
+        value = match.group(2)
+        params.append(float(value) if "." in value else int(value))
+        return f"{match.group(1)} ?"
+
+    # Odd-indexed parts are quoted strings; only rewrite outside them.
+    parts = re.split(r"('[^']*')", sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = _NUM_LITERAL_RE.sub(repl, parts[i])
+
+    return "".join(parts), params
+
+
 def execute_sql(sql, cursor):
-    cursor.execute(sql)
+    cursor.arraysize = 1000
+
+    sql, params = parameterize_sql(sql)
+    if params:
+        cursor.execute(sql, params)
+    else:
+        cursor.execute(sql)
 
     columns = [col[0] for col in cursor.description]
-    rows = cursor.fetchall()
+
+    rows = []
+    while len(rows) < MAX_RESULT_ROWS:
+        chunk = cursor.fetchmany(cursor.arraysize)
+        if not chunk:
+            break
+        rows.extend(chunk)
 
     if not rows:
         return {"type": "empty", "data": []}
@@ -505,18 +803,29 @@ def execute_sql(sql, cursor):
     return {
         "type": "table",
         "columns": columns,
-        "data": [dict(zip(columns, row)) for row in rows]
+        "data": [list(row) for row in rows]
     }
 
 # ---------------- HUMAN ANSWER ----------------
-def generate_human_answer(question, result):
-    client = AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version="2024-12-01-preview",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
+# Results small enough to read directly don't need a summarization
+# round-trip; only larger tables go to the LLM.
+SMALL_TABLE_ROWS = 3
+
+
+def format_answer(question, result):
+    if result["type"] == "scalar":
+        return f"{question.strip().rstrip('?')}: {result['data']}"
+
+    columns = result["columns"]
+    bullets = []
+    for i, row in enumerate(result["data"], start=1):
+        cells = ", ".join(f"{col}: {val}" for col, val in zip(columns, row))
+        bullets.append(f"{i}. {cells}")
+
+    return "Here is what was found for your question.  " + "  ".join(bullets)
+
 
-    system_prompt = """
+_HUMAN_ANSWER_SYSTEM_PROMPT = """
 You are a law firm analytics assistant.
 
 STRICT RULES:
@@ -531,80 +840,131 @@ STRICT RULES:
 FORMAT RULES:
 • If result type is 'scalar', return one clear sentence
 • If result type is 'table':
-  - write the first sentence exlaining the answer or question relation 
+  - write the first sentence exlaining the answer or question relation
   - Format each row as a bullet using 'numbers'
   - Strictly Do NOT use newline or /n characters
   - Separate bullets with two spaces
 • If result is empty, say no data was found
 """
 
+
+def generate_human_answer(question, result):
     user_prompt = f"""
 Question:
 {question}
 
 Result:
-{json.dumps(result, default=str)}
+{orjson.dumps(result, default=str).decode()}
 
 Generate the final answer.
 """
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        temperature=0
-    )
+    content = _chat(_HUMAN_ANSWER_SYSTEM_PROMPT, user_prompt, max_tokens=300)
+
+    return content.strip()
 
-    return response.choices[0].message.content.strip()
+# ---------------- WARMUP ----------------
+def warm_up():
+    tenants = [
+        t.strip()
+        for t in os.getenv("WARMUP_TENANTS", "").split(",")
+        if t.strip()
+    ]
+
+    # Pay the credential/connection/schema cold-start once at boot
+    # instead of on the first /query per tenant.
+    for tenant in tenants:
+        try:
+            fetch_schema(tenant)
+        except Exception:
+            app.logger.exception("warmup failed for tenant %s", tenant)
+
+    # One throwaway completion warms the httpx TLS pool to Azure OpenAI;
+    # useful regardless of whether any tenants are configured.
+    try:
+        openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1
+        )
+    except Exception:
+        app.logger.exception("OpenAI warmup failed")
+
+
+warm_up()
 
 # ---------------- HEALTH CHECK ----------------
 @app.route("/health", methods=["GET"])
 def health():
     return {"status": "ok"}
 
+# ---------------- SCHEMA INVALIDATION ----------------
+@app.route("/schema/invalidate", methods=["POST"])
+def invalidate_schema():
+    data = request.get_json(force=True, silent=True) or {}
+    company_name = data.get("company_name")
+
+    with _schema_cache_lock:
+        if company_name:
+            _schema_cache.pop(company_name, None)
+        else:
+            _schema_cache.clear()
+
+    return jsonify({"status": "ok"})
+
 # ---------------- MAIN API ----------------
 @app.route("/query", methods=["POST","GET"])
 def query():
     try:
-        data = request.get_json(force=True)
+        try:
+            data = orjson.loads(request.get_data() or b"{}")
+        except orjson.JSONDecodeError:
+            return jsonify({"error": "Request body must be valid JSON"}), 400
+
+        if not isinstance(data, dict):
+            data = {}
 
         question = data.get("question")
         company_name = data.get("company_name")
 
-        if not question or not company_name:
+        if not isinstance(question, str) or not question \
+                or not isinstance(company_name, str) or not company_name:
             return jsonify({
                 "error": "Both 'question' and 'company_name' are required"
             }), 400
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        schema = fetch_schema(company_name)
 
-        schema = get_schema_info(cursor, company_name)
+        if not question_is_answerable(question, schema):
+            return jsonify({
+                "answer": "I couldn’t find enough data to answer that question."
+            })
 
         sql = generate_sql(question, schema, company_name)
 
-        print("Generated SQL:", sql)
+        app.logger.info("Generated SQL: %s", sql)
 
         if not sql:
             return jsonify({
                 "answer": "I couldn’t find enough data to answer that question."
             })
 
-        result = execute_sql(sql, cursor)
+        result = run_sql(sql)
 
         if result["type"] == "empty":
             return jsonify({
                 "answer": "No data was found for this question."
             })
 
+        if result["type"] == "scalar" or len(result["data"]) <= SMALL_TABLE_ROWS:
+            return jsonify({"answer": format_answer(question, result)})
+
         human_answer = generate_human_answer(question, result)
 
         return jsonify({"answer": human_answer})
 
     except Exception as e:
-        traceback.print_exc()
+        app.logger.exception("query failed")
         return jsonify({"error": str(e)}), 500
 
 # ---------------- RUN ----------------